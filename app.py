@@ -6,7 +6,8 @@ from flask_migrate import Migrate
 
 # Third-party imports
 from twilio.twiml.messaging_response import MessagingResponse
-from openai import OpenAI
+from twilio.rest import Client
+from openai import OpenAI, APITimeoutError, APIConnectionError, RateLimitError, InternalServerError
 from pydantic import BaseModel
 import requests
 import json
@@ -21,13 +22,20 @@ import numpy as np
 from io import BytesIO
 from PIL import Image
 import requests
-from skimage.metrics import structural_similarity as ssim
 import tempfile
 import os
+from concurrent.futures import ThreadPoolExecutor, wait
 
 # wha7_models imports
 from wha7_models import init_db, PhoneNumber, Outfit, Item, Link, ReferralCode, Referral
 
+# Local imports
+from prefilter import is_fashion_candidate_base64
+from model_calls import ModelEndpoint
+from reel_frames import extract_reel_frames, ReelBusyError, ReelTimeoutError
+from recommendation_index import RecommendationIndex, RECOMMENDATION_INDEX_DIR
+from outfit_history import create_history_blueprint, issue_history_token, invalidate_history_cache, store_thumbnail
+
 # Create Flask app and db instance
 app = Flask(__name__)
 CORS(app)
@@ -67,6 +75,9 @@ with app.app_context():
     db.create_all()
     migrate = Migrate(app, db)
 
+# Outfit history read API (/outfits)
+app.register_blueprint(create_history_blueprint(session_factory, Outfit, Item))
+
 # Your pydantic models remain the same
 class clothing(BaseModel):
     Item: str
@@ -84,6 +95,22 @@ class Outfits(BaseModel):
 
 
 EBAY_ENDPOINT = "https://api.ebay.com/buy/browse/v1/item_summary/search?q="
+RETRY_MESSAGE = "I'm sorry, I'm not sure how to respond to that. Can you retry?"
+
+# Model call deadlines (seconds), hedging and circuit breaker settings
+UNAVAILABLE_MESSAGE = "Sorry, our stylist is a little busy right now. Please try again in a few minutes."
+MODEL_HEDGE_ENABLED = os.getenv('MODEL_HEDGE_ENABLED', 'false').lower() == 'true'
+MODEL_MAX_ATTEMPTS = int(os.getenv('MODEL_MAX_ATTEMPTS', 2))
+MODEL_BREAKER_FAILURES = int(os.getenv('MODEL_BREAKER_FAILURES', 5))
+MODEL_BREAKER_RESET = float(os.getenv('MODEL_BREAKER_RESET', 30))
+# Only upstream trouble is retried and trips the breaker; bad requests and refusals are not
+MODEL_RETRYABLE_ERRORS = (APITimeoutError, APIConnectionError, RateLimitError, InternalServerError)
+
+# MMS handling: Twilio gives up on the webhook after 15 seconds, so reply inline only within this budget
+WAITLIST_URL = "https://www.wha7.com/f/5f804b34-9f3a-4bd6-a9e5-bf21e2a9018d"
+SMS_REPLY_DEADLINE = float(os.getenv('SMS_REPLY_DEADLINE', 10))
+SMS_MEDIA_WORKERS = int(os.getenv('SMS_MEDIA_WORKERS', 8))
+SMS_MAX_LENGTH = 1600  # Twilio rejects longer bodies with error 21617
 
 prompt = """Identify all clothing and accessory items in an image with detailed characteristics, ensuring no item is missed.
 
@@ -193,7 +220,48 @@ recommendations = Recommendations(
 )
 Output the Recommendations object as a JSON string, ensuring all entries follow current fashion trends and availability."""
 
-client = OpenAI()
+# Retries are handled by the endpoint wrappers so they share one deadline
+client = OpenAI(max_retries=0)
+twilio_client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
+
+# Shared across requests so concurrent MMS downloads and analyses stay within one budget per worker
+sms_media_executor = ThreadPoolExecutor(max_workers=SMS_MEDIA_WORKERS, thread_name_prefix="sms-media")
+sms_followup_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="sms-followup")
+
+image_endpoint = ModelEndpoint(
+    "openai-image",
+    deadline=float(os.getenv('MODEL_DEADLINE_IMAGE', 45)),
+    max_attempts=MODEL_MAX_ATTEMPTS,
+    hedge=MODEL_HEDGE_ENABLED,
+    failure_threshold=MODEL_BREAKER_FAILURES,
+    reset_timeout=MODEL_BREAKER_RESET,
+    retryable=MODEL_RETRYABLE_ERRORS,
+)
+text_endpoint = ModelEndpoint(
+    "openai-text",
+    deadline=float(os.getenv('MODEL_DEADLINE_TEXT', 20)),
+    max_attempts=MODEL_MAX_ATTEMPTS,
+    hedge=MODEL_HEDGE_ENABLED,
+    failure_threshold=MODEL_BREAKER_FAILURES,
+    reset_timeout=MODEL_BREAKER_RESET,
+    retryable=MODEL_RETRYABLE_ERRORS,
+)
+embedding_endpoint = ModelEndpoint(
+    "openai-embedding",
+    deadline=float(os.getenv('MODEL_DEADLINE_EMBEDDING', 5)),
+    max_attempts=MODEL_MAX_ATTEMPTS,
+    hedge=MODEL_HEDGE_ENABLED,
+    failure_threshold=MODEL_BREAKER_FAILURES,
+    reset_timeout=MODEL_BREAKER_RESET,
+    retryable=MODEL_RETRYABLE_ERRORS,
+)
+
+def embed_texts(model, texts):
+    response = embedding_endpoint.call(lambda timeout: client.embeddings.create(model=model, input=texts, timeout=timeout))
+    return [item.embedding for item in response.data]
+
+# Local catalog snapshot for recommendation ids; the remote rag_search is only a fallback
+recommendation_index = RecommendationIndex(RECOMMENDATION_INDEX_DIR, embed_texts)
 
 
 @app.route("/sms", methods=['POST'])
@@ -201,35 +269,103 @@ def sms_reply():
     # Extract incoming message information
     db.create_all()
     from_number = request.form.get('From')
-    media_url = request.form.get('MediaUrl0')  # This will be the first image URL
+    to_number = request.form.get('To')
     text = request.form.get('Body')
+    num_media = int(request.form.get('NumMedia', 0) or 0)
+    # Only images go to the vision model; vCards, videos and audio would just cost a failed call
+    media_urls = [
+        request.form.get(f'MediaUrl{i}')
+        for i in range(num_media)
+        if request.form.get(f'MediaContentType{i}', '').startswith('image/')
+    ]
+    media_urls = [url for url in media_urls if url]
 
-    if media_url:        
-        response = requests.get(media_url, auth=(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN))
-        if response.status_code == 200:
-            image_content = response.content
-            base64_image = base64.b64encode(image_content).decode('utf-8')
-            clothing_items = process_response(base64_image,from_number,text)
-
-            # Construct response message
-            if(clothing_items.Purpose == 1):
-                resp = MessagingResponse()
-                resp.message(f"{clothing_items.Response} You can view the outfit on the Wha7 app. Join the waitlist at https://www.wha7.com/f/5f804b34-9f3a-4bd6-a9e5-bf21e2a9018d")
-                return str(resp)
-            elif(clothing_items.Purpose == 2):
-                resp = MessagingResponse()
-                resp.message(f"{clothing_items.Response}")
-                return str(resp)
-            elif(clothing_items.Purpose == 3):
-                resp = MessagingResponse()
-                resp.message("I'm sorry, I'm not sure how to respond to that. Can you retry?")
-                return str(resp)
-        else:
+    resp = MessagingResponse()
+    if not media_urls:
+        resp.message(f"Please send a screenshot of a TikTok or Reel. You can access outfits you've already shared on our app or after signing up via {WAITLIST_URL}")
+        return str(resp)
+
+    futures = [sms_media_executor.submit(process_sms_media, url, from_number, text) for url in media_urls]
+    _, not_done = wait(futures, timeout=SMS_REPLY_DEADLINE)
+    if not not_done:
+        for body in split_sms_body(build_sms_reply([future.result() for future in futures])):
+            resp.message(body)
+        return str(resp)
+
+    # Analysis is running long: ack now and send the combined reply through the REST API
+    sms_followup_executor.submit(send_sms_followup, futures, from_number, to_number)
+    resp.message("Got it! We're still working on your outfit and will text you the results shortly.")
+    return str(resp)
+
+def process_sms_media(media_url, from_number, text):
+    """Download and analyze one MMS attachment, returning None if it could not be fetched"""
+    try:
+        response = requests.get(media_url, auth=(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN), timeout=10)
+        if response.status_code != 200:
+            print(f"Media fetch failed with status {response.status_code}: {media_url}")
+            return None
+        base64_image = base64.b64encode(response.content).decode('utf-8')
+        return process_response(base64_image, from_number, text)
+    except Exception as e:
+        print(f"Error processing media {media_url}: {e}")
+        return None
+
+def build_sms_reply(results):
+    """Combine the analysis of every attachment into a single reply"""
+    outfits = [result for result in results if result is not None and result.Purpose == 1]
+    answers = [result for result in results if result is not None and result.Purpose == 2]
+
+    if not outfits and not answers:
+        if all(result is None for result in results):
             return "Error: Unable to fetch the image."
+        return RETRY_MESSAGE
+
+    parts = [answer.Response for answer in answers]
+    if len(outfits) == 1:
+        parts.append(outfits[0].Response)
     else:
-        resp = MessagingResponse()
-        resp.message("Please send a screenshot of a TikTok or Reel. You can access outfits you've already shared on our app or after signing up via https://www.wha7.com/f/5f804b34-9f3a-4bd6-a9e5-bf21e2a9018d")
-        return str(resp)
+        parts.extend(f"Outfit {idx + 1}: {outfit.Response}" for idx, outfit in enumerate(outfits))
+    reply = "\n\n".join(parts)
+    if outfits:
+        reply += f" You can view the outfit on the Wha7 app. Join the waitlist at {WAITLIST_URL}"
+    return reply
+
+def split_sms_body(body, limit=SMS_MAX_LENGTH):
+    """Split a reply into messages within Twilio's body limit, breaking between outfits or words where possible"""
+    messages = []
+    while len(body) > limit:
+        cut = body.rfind("\n\n", 0, limit)
+        if cut <= 0:
+            cut = body.rfind(" ", 0, limit)
+        if cut <= 0:
+            cut = limit
+        messages.append(body[:cut].rstrip())
+        body = body[cut:].lstrip()
+    messages.append(body)
+    return messages
+
+def send_sms_followup(futures, from_number, to_number):
+    """Wait for the remaining attachments and text the combined reply, falling back to an error message"""
+    try:
+        wait(futures)
+        bodies = split_sms_body(build_sms_reply([future.result() for future in futures]))
+    except Exception as e:
+        print(f"Error building SMS follow-up for {from_number}: {e}")
+        bodies = [UNAVAILABLE_MESSAGE]
+
+    sent = 0
+    try:
+        for body in bodies:
+            twilio_client.messages.create(to=from_number, from_=to_number, body=body)
+            sent += 1
+    except Exception as e:
+        print(f"Error sending SMS follow-up to {from_number}: {e}")
+        # The user was already told results are coming, so don't leave them with nothing
+        if not sent:
+            try:
+                twilio_client.messages.create(to=from_number, from_=to_number, body=UNAVAILABLE_MESSAGE)
+            except Exception as e:
+                print(f"Error sending SMS fallback to {from_number}: {e}")
 
 
 @app.route("/ios/consultant", methods=['POST'])
@@ -239,19 +375,34 @@ def ios_consultant():
     text = data.get('text')
     from_number = format_phone_number(data.get('from_number'))
     Clothing_Items = process_response(image_content, from_number, text, prompt_text=recommendation_prompt, format=Recommendations)
+    articles = Clothing_Items.Recommendations or []
+    recommendation_ids = get_recommendation_ids([article.Item for article in articles])
 
     return jsonify({
         "response": Clothing_Items.Response,
+        "history_token": get_history_token(from_number),
         "recommendations": [
             {
                 "Item": article.Item,
                 "Amazon_Search": article.Amazon_Search,
-                "Recommendation_ID": get_recommendation_id(article.Item)
+                "Recommendation_ID": recommendation_id
             } 
-            for article in (Clothing_Items.Recommendations or [])
+            for article, recommendation_id in zip(articles, recommendation_ids)
         ]
     })
 
+def get_history_token(from_number):
+    """
+    Token the iOS app sends as "Authorization: Bearer <token>" to read /outfits for this phone number,
+    or None if the number has no history yet or no signing secret is configured
+    """
+    Session = session_factory()
+    try:
+        phone = Session.query(PhoneNumber.id).filter_by(phone_number=from_number).first()
+    finally:
+        Session.close()
+    return issue_history_token(phone.id) if phone else None
+
 @app.route("/ios", methods=['POST'])
 def ios_image():
     # Get data from request body instead of args
@@ -271,7 +422,7 @@ def analyze_text_with_openai(text=None, true_prompt=prompt,format=Outfits):
     try:
         # Example of using OpenAI to generate a response about clothing items
         # Assuming OpenAI GPT-4 can analyze text data about images (would need further development for visual analysis)
-        response = client.beta.chat.completions.parse(
+        response = text_endpoint.call(lambda timeout: client.beta.chat.completions.parse(
             model="gpt-4o-mini",
             messages=[
                 {"role": "system", "content": "You are an expert at structured data extraction. You will be given a photo and should convert it into the given structure."},
@@ -291,16 +442,18 @@ def analyze_text_with_openai(text=None, true_prompt=prompt,format=Outfits):
             ],
             response_format=format,
             max_tokens=5000,
-        )
+            timeout=timeout,
+        ))
         return response.choices[0].message.parsed
     except Exception as e:
-        print(f"Error analyzing image with OpenAI: {e}")
-        return None   
+        print(f"Error analyzing text with OpenAI: {e}")
+        return None
+
 def analyze_image_with_openai(base64_image=None,text=None,true_prompt=prompt,format=Outfits):
     try:
         # Example of using OpenAI to generate a response about clothing items
         # Assuming OpenAI GPT-4 can analyze text data about images (would need further development for visual analysis)
-        response = client.beta.chat.completions.parse(
+        response = image_endpoint.call(lambda timeout: client.beta.chat.completions.parse(
             model="gpt-4o-mini",
             messages=[
                 {"role": "system", "content": "You are an expert at structured data extraction. You will be given a photo and should convert it into the given structure."},
@@ -326,21 +479,37 @@ def analyze_image_with_openai(base64_image=None,text=None,true_prompt=prompt,for
             ],
             response_format=format,
             max_tokens=5000,
-        )
+            timeout=timeout,
+        ))
         return response.choices[0].message.parsed
     except Exception as e:
         print(f"Error analyzing image with OpenAI: {e}")
         return None
-def process_response(base64_image, from_number, text, prompt_text=prompt, format=Outfits, instagram_username=None):
+def process_response(base64_image, from_number, text, prompt_text=prompt, format=Outfits, instagram_username=None, prefiltered=False):
     if base64_image:
+        # Skip the vision call for blank frames, blurry frames and text screenshots;
+        # reel frames have already been checked in the reel pool
+        if format == Outfits and not prefiltered and not is_fashion_candidate_base64(base64_image):
+            print("Image rejected by local pre-filter")
+            return Outfits(Outfits="", Response=RETRY_MESSAGE, Purpose=3, Article=[])
         base64_image_data = f"data:image/jpeg;base64,{base64_image}"
         clothing_items = analyze_image_with_openai(base64_image_data, text, prompt_text, format)
+        if clothing_items is None:
+            return unavailable_response(format)
         if format == Outfits:
             database_commit(clothing_items, from_number, base64_image_data, instagram_username)
     else:
-        clothing_items = analyze_text_with_openai(text=text, true_prompt=prompt_text, format=format)      
+        clothing_items = analyze_text_with_openai(text=text, true_prompt=prompt_text, format=format)
+        if clothing_items is None:
+            return unavailable_response(format)
     return clothing_items
 
+def unavailable_response(format):
+    """Graceful reply used when the model call fails or the circuit breaker is open"""
+    if format == Recommendations:
+        return Recommendations(Response=UNAVAILABLE_MESSAGE, Recommendations=[])
+    return Outfits(Outfits="", Response=UNAVAILABLE_MESSAGE, Purpose=2, Article=[])
+
 def shorten_url(long_url):
     # Define the endpoint URL (change port if necessary)
     url = 'https://item.wha7.com/shorten'
@@ -360,14 +529,26 @@ def shorten_url(long_url):
     else:
         print('Error:', response.json().get('error'))
         return None   
-def get_recommendation_id(item_description):
+def get_recommendation_ids(item_descriptions):
+    """Look up recommendation ids in the local index in one batch, falling back to rag_search per miss"""
+    local_ids = recommendation_index.lookup(item_descriptions)
+    return [
+        item_id if item_id is not None else get_remote_recommendation_id(item_description)
+        for item_description, item_id in zip(item_descriptions, local_ids)
+    ]
+
+def get_remote_recommendation_id(item_description):
+    """Look up a recommendation id with the remote rag_search, returning None on failure"""
     flask_api_url = "https://access.wha7.com/rag_search"  # Replace with your actual URL
-    response = requests.post(flask_api_url, json={"item_description": item_description})
-    if response.status_code == 200:
-        return response.json()["item_id"]  # Assuming your API returns the item_id
-    else:
-        # Handle error (e.g., log the error, return a default value)
-        return "Error"
+    try:
+        response = requests.post(flask_api_url, json={"item_description": item_description}, timeout=10)
+        if response.status_code == 200:
+            return response.json()["item_id"]  # Assuming your API returns the item_id
+        print(f"rag_search failed with status {response.status_code}: {response.text}")
+    except (requests.RequestException, ValueError, KeyError) as e:
+        print(f"Error calling rag_search: {e}")
+    return None
+
 def database_commit(clothing_items, from_number, base64_image_data=None, instagram_username=None):
     with app.app_context():
         Session = session_factory()
@@ -402,6 +583,9 @@ def database_commit(clothing_items, from_number, base64_image_data=None, instagr
             outfit = Outfit(phone_id=phone.id, image_data=base64_image_data, description="Outfit from image")
             Session.add(outfit)
             Session.commit()
+            if base64_image_data:
+                # Render the history thumbnail now so reads never have to load the full image
+                store_thumbnail(outfit.id, phone.id, base64_image_data)
                     
             if clothing_items.Article is not None:
                 for item in clothing_items.Article:
@@ -415,6 +599,7 @@ def database_commit(clothing_items, from_number, base64_image_data=None, instagr
                     Session.commit()
             else:
                 print("No items found in clothing_items.Article")
+            invalidate_history_cache(phone.id)
         finally:
             Session.close()
 
@@ -574,7 +759,7 @@ def handle_instagram_messages():
                                         elif clothing_items.Purpose == 2:
                                             reply = clothing_items.Response
                                         else:
-                                            reply = "I'm sorry, I'm not sure how to respond to that. Can you retry?"
+                                            reply = RETRY_MESSAGE
 
                                         print(f"11. Sending final reply: {reply}")
                                         response = send_graph_api_reply(sender_id, reply)
@@ -631,16 +816,6 @@ def get_username(sender_id):
         return None
 
 
-
-def resize_frame_with_aspect_ratio(frame, target_width=640):
-    """
-    Resize frame while maintaining aspect ratio
-    """
-    height, width = frame.shape[:2]
-    aspect_ratio = width / height
-    target_height = int(target_width / aspect_ratio)
-    return cv2.resize(frame, (target_width, target_height))
-
 def process_reels(reel_url, instagram_username, sender_id):
     try:
         response = requests.get(reel_url, stream=True, timeout=10)
@@ -654,49 +829,20 @@ def process_reels(reel_url, instagram_username, sender_id):
             temp_file_path = temp_file.name
         
         try:
-            video = cv2.VideoCapture(temp_file_path)
-            if not video.isOpened():
+            # Decoding, SSIM and JPEG encoding run in the reel process pool, off this worker's GIL
+            try:
+                unique_frames = extract_reel_frames(temp_file_path)
+            except ReelBusyError:
+                final_reply = "We're processing a lot of reels right now. Please try again in a few minutes."
+                send_graph_api_reply(sender_id, final_reply)
+                return final_reply
+            except ReelTimeoutError:
+                final_reply = "Sorry, that reel took too long to process. Please try a shorter clip."
+                send_graph_api_reply(sender_id, final_reply)
+                return final_reply
+            if unique_frames is None:
                 return "Sorry, I couldn't process the reel. Please try again."
 
-            fps = min(video.get(cv2.CAP_PROP_FPS), 30)
-            total_frames = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
-            max_frames_to_process = min(total_frames, 300)
-            frame_interval = int(fps * 2)
-            similarity_threshold = 0.80
-
-            unique_frames = []
-            previous_frame = None
-            frame_count = 0
-            max_unique_frames = 5
-
-            while video.isOpened() and frame_count < max_frames_to_process and len(unique_frames) < max_unique_frames:
-                ret, frame = video.read()
-                if not ret:
-                    break
-
-                if frame_count % frame_interval == 0:
-                    # Resize for comparison while maintaining aspect ratio
-                    processing_frame = resize_frame_with_aspect_ratio(frame, target_width=640)
-                    gray_frame = cv2.cvtColor(processing_frame, cv2.COLOR_BGR2GRAY)
-
-                    is_unique = True
-                    if previous_frame is not None:
-                        if previous_frame.shape != gray_frame.shape:
-                            gray_frame = cv2.resize(gray_frame, previous_frame.shape[::-1])
-                        similarity = ssim(previous_frame, gray_frame)
-                        is_unique = similarity < similarity_threshold
-
-                    if is_unique:
-                        # Store original frame (not the resized version) in base64
-                        success, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 95])
-                        if success:
-                            base64_image = base64.b64encode(buffer).decode('utf-8')
-                            unique_frames.append(base64_image)
-                            previous_frame = gray_frame
-
-                frame_count += 1
-
-            video.release()
             # Process frames with error handling for each
             all_responses = []
             send_graph_api_reply(sender_id,"🎯 Target acquired! Processing your awesome content 🔄")
@@ -706,7 +852,8 @@ def process_reels(reel_url, instagram_username, sender_id):
                         base64_image,
                         None,
                         "",
-                        instagram_username=instagram_username
+                        instagram_username=instagram_username,
+                        prefiltered=True
                     )
 
                     if hasattr(clothing_items, 'Purpose') and clothing_items.Purpose == 1:
@@ -734,8 +881,6 @@ def process_reels(reel_url, instagram_username, sender_id):
             return final_reply
 
         finally:
-            if 'video' in locals():
-                video.release()
             if os.path.exists(temp_file_path):
                 try:
                     os.unlink(temp_file_path)
@@ -0,0 +1,169 @@
+# Deadlines, hedged requests, retries and a circuit breaker for upstream model calls
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+class ModelCallError(Exception):
+    """Raised when a model call could not be completed within its deadline"""
+
+
+class CircuitOpenError(ModelCallError):
+    """Raised without calling upstream while the circuit breaker is open"""
+
+
+class CircuitBreaker:
+    """
+    Opens after failure_threshold consecutive failures and fails fast for reset_timeout seconds,
+    then lets a single trial call through (half-open) to decide whether to close again
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at < self.reset_timeout or self.trial_in_flight:
+                return False
+            self.trial_in_flight = True
+            return True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_flight = False
+
+    def release(self):
+        """End a half-open trial without changing state, e.g. when it was rejected as a bad request"""
+        with self.lock:
+            self.trial_in_flight = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_in_flight = False
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+class ModelEndpoint:
+    """
+    Wraps calls to one upstream endpoint with:
+    - an overall deadline shared by all attempts, passed to each call as its timeout
+    - an optional hedged duplicate request once the primary exceeds the observed p95 latency
+    - retries with full jitter while the deadline allows
+    - a circuit breaker that fails fast when the upstream keeps failing
+
+    Only errors in retryable (plus missed deadlines) are retried and counted by the breaker;
+    anything else, such as a rejected request, is re-raised straight away.
+    """
+
+    def __init__(self, name, deadline, max_attempts=2, backoff_base=0.5, hedge=False,
+                 hedge_min_samples=20, failure_threshold=5, reset_timeout=30,
+                 retryable=(TimeoutError, ConnectionError), max_workers=32, executor=None):
+        self.name = name
+        self.deadline = deadline
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.hedge = hedge
+        self.hedge_min_samples = hedge_min_samples
+        self.retryable = tuple(retryable) + (ModelCallError,)
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.latencies = deque(maxlen=200)
+        self.latencies_lock = threading.Lock()
+        # Only used for hedged attempts; unhedged attempts run on the caller's thread
+        self.executor = executor
+        if hedge and executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"model-{name}")
+
+    def hedge_delay(self):
+        """Return the p95 latency of recent successful calls, or None until enough samples exist"""
+        with self.latencies_lock:
+            if len(self.latencies) < self.hedge_min_samples:
+                return None
+            ordered = sorted(self.latencies)
+        return ordered[int(len(ordered) * 0.95) - 1]
+
+    def timed(self, fn, deadline):
+        # The timeout is taken when the call actually starts, so time spent queued is not given to upstream
+        start = time.monotonic()
+        if deadline - start <= 0:
+            raise ModelCallError(f"{self.name} call expired before it started")
+        result = fn(deadline - start)
+        with self.latencies_lock:
+            self.latencies.append(time.monotonic() - start)
+        return result
+
+    def attempt(self, fn, deadline):
+        """Run one attempt, hedging it with a duplicate request if it is slower than p95"""
+        hedge_delay = self.hedge_delay() if self.hedge else None
+        if hedge_delay is None or hedge_delay >= deadline - time.monotonic():
+            return self.timed(fn, deadline)
+
+        futures = [self.executor.submit(self.timed, fn, deadline)]
+        done, _ = wait(futures, timeout=hedge_delay)
+        if not done:
+            print(f"Hedging {self.name} call after {hedge_delay:.2f}s")
+            futures.append(self.executor.submit(self.timed, fn, deadline))
+
+        error = None
+        pending = set(futures)
+        try:
+            while pending:
+                done, pending = wait(pending, timeout=max(deadline - time.monotonic(), 0), return_when=FIRST_COMPLETED)
+                if not done:
+                    break
+                for future in done:
+                    if future.exception() is None:
+                        return future.result()
+                    error = future.exception()
+                    if not isinstance(error, self.retryable):
+                        raise error
+        finally:
+            # Calls that have not started yet are dropped; running ones are bounded by their own timeout
+            for future in pending:
+                future.cancel()
+        raise error or ModelCallError(f"{self.name} call exceeded its deadline")
+
+    def call(self, fn):
+        """
+        Call fn(timeout) and return its result.
+        fn must honour the timeout it is given so abandoned attempts do not outlive the deadline.
+        """
+        if not self.breaker.allow():
+            raise CircuitOpenError(f"{self.name} circuit is open")
+
+        deadline = time.monotonic() + self.deadline
+        error = None
+        for attempt in range(self.max_attempts):
+            if deadline - time.monotonic() <= 0:
+                break
+            try:
+                result = self.attempt(fn, deadline)
+                self.breaker.record_success()
+                return result
+            except self.retryable as e:
+                error = e
+                print(f"{self.name} attempt {attempt + 1} failed: {e}")
+            except Exception:
+                # The upstream answered; a bad request says nothing about its health
+                self.breaker.release()
+                raise
+            if attempt + 1 == self.max_attempts:
+                break
+            # Full jitter backoff, never sleeping past the deadline
+            backoff = random.uniform(0, self.backoff_base * (2 ** attempt))
+            time.sleep(max(min(backoff, deadline - time.monotonic()), 0))
+
+        self.breaker.record_failure()
+        raise ModelCallError(f"{self.name} call failed: {error}")
@@ -0,0 +1,304 @@
+# Paginated outfit history read API, serving thumbnails instead of the stored base64 images
+import hashlib
+import hmac
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import cv2
+from dotenv import load_dotenv
+from flask import Blueprint, request, jsonify, url_for, make_response
+from sqlalchemy import func
+
+from prefilter import decode_base64_image
+
+load_dotenv()
+
+HISTORY_PAGE_SIZE = int(os.getenv('HISTORY_PAGE_SIZE', 20))
+HISTORY_MAX_PAGE_SIZE = 100
+HISTORY_CACHE_USERS = int(os.getenv('HISTORY_CACHE_USERS', 1000))
+THUMBNAIL_WIDTH = int(os.getenv('THUMBNAIL_WIDTH', 256))
+THUMBNAIL_CACHE_SIZE = int(os.getenv('THUMBNAIL_CACHE_SIZE', 2000))  # ~15KB each
+HISTORY_TOKEN_TTL = int(os.getenv('HISTORY_TOKEN_TTL', 30 * 24 * 3600))
+
+
+def derive_token_secret():
+    """
+    Secret used to sign history tokens. HISTORY_TOKEN_SECRET wins; otherwise a key is derived from
+    TWILIO_AUTH_TOKEN so every worker signs with the same key without extra configuration
+    """
+    secret = os.getenv('HISTORY_TOKEN_SECRET')
+    if secret:
+        return secret
+    twilio_token = os.getenv('TWILIO_AUTH_TOKEN')
+    if twilio_token:
+        return hmac.new(twilio_token.encode(), b'wha7-history-token', hashlib.sha256).hexdigest()
+    return None
+
+
+HISTORY_TOKEN_SECRET = derive_token_secret()
+
+
+def history_token_signature(phone_id, expires):
+    message = f"{phone_id}.{expires}".encode()
+    return hmac.new(HISTORY_TOKEN_SECRET.encode(), message, hashlib.sha256).hexdigest()
+
+
+def issue_history_token(phone_id, ttl=HISTORY_TOKEN_TTL):
+    """
+    Per-user token for the history endpoints, or None when no signing secret is configured.
+    Returned to the iOS app by /ios/consultant for the phone number it was called with.
+    """
+    if not HISTORY_TOKEN_SECRET:
+        return None
+    expires = int(time.time()) + ttl
+    return f"{phone_id}.{expires}.{history_token_signature(phone_id, expires)}"
+
+
+def authenticated_phone_id():
+    """
+    Return the phone_id of the caller from an "Authorization: Bearer <token>" header
+    (or a token query parameter, so thumbnails work in image tags), or None if it is missing or invalid
+    """
+    if not HISTORY_TOKEN_SECRET:
+        return None
+    token = request.args.get('token')
+    authorization = request.headers.get('Authorization', '')
+    if authorization.startswith('Bearer '):
+        token = authorization[len('Bearer '):]
+    try:
+        phone_id, expires, signature = token.split('.')
+        phone_id, expires = int(phone_id), int(expires)
+    except (AttributeError, ValueError):
+        return None
+    if expires < time.time() or not hmac.compare_digest(signature, history_token_signature(phone_id, expires)):
+        return None
+    return phone_id
+
+
+# Per-user cache of history pages, keyed by phone_id then (before, limit).
+# Entries are tagged with the user's history version, so a commit made in another worker is picked up
+# on the next read even though only this worker's cache is invalidated by database_commit.
+history_cache = OrderedDict()
+history_cache_lock = threading.Lock()
+
+
+def get_cached_history(phone_id, version, key):
+    with history_cache_lock:
+        entry = history_cache.get(phone_id)
+        if entry is None or entry['version'] != version:
+            return None
+        history_cache.move_to_end(phone_id)
+        return entry['pages'].get(key)
+
+
+def set_cached_history(phone_id, version, key, payload):
+    with history_cache_lock:
+        entry = history_cache.get(phone_id)
+        if entry is None or entry['version'] != version:
+            entry = history_cache[phone_id] = {'version': version, 'pages': {}}
+        entry['pages'][key] = payload
+        history_cache.move_to_end(phone_id)
+        while len(history_cache) > HISTORY_CACHE_USERS:
+            history_cache.popitem(last=False)
+
+
+def invalidate_history_cache(phone_id):
+    with history_cache_lock:
+        history_cache.pop(phone_id, None)
+
+
+# Rendered thumbnails keyed by (outfit_id, THUMBNAIL_WIDTH), holding (phone_id, jpeg bytes) so the
+# ownership check does not need the database either. Filled when an outfit is saved and on first read.
+thumbnail_cache = OrderedDict()
+thumbnail_cache_lock = threading.Lock()
+
+
+def get_cached_thumbnail(outfit_id):
+    with thumbnail_cache_lock:
+        entry = thumbnail_cache.get((outfit_id, THUMBNAIL_WIDTH))
+        if entry is not None:
+            thumbnail_cache.move_to_end((outfit_id, THUMBNAIL_WIDTH))
+        return entry
+
+
+def set_cached_thumbnail(outfit_id, phone_id, thumbnail):
+    with thumbnail_cache_lock:
+        thumbnail_cache[(outfit_id, THUMBNAIL_WIDTH)] = (phone_id, thumbnail)
+        thumbnail_cache.move_to_end((outfit_id, THUMBNAIL_WIDTH))
+        while len(thumbnail_cache) > THUMBNAIL_CACHE_SIZE:
+            thumbnail_cache.popitem(last=False)
+
+
+def store_thumbnail(outfit_id, phone_id, image_data):
+    """Render and cache a thumbnail while the image is still in memory, e.g. right after it is saved"""
+    thumbnail = render_thumbnail(image_data)
+    if thumbnail is not None:
+        set_cached_thumbnail(outfit_id, phone_id, thumbnail)
+
+
+def render_thumbnail(image_data):
+    """Decode a stored base64 image and re-encode it as a small JPEG, or None if that fails"""
+    frame = decode_base64_image(image_data)
+    if frame is None:
+        return None
+    height, width = frame.shape[:2]
+    if width > THUMBNAIL_WIDTH:
+        frame = cv2.resize(frame, (THUMBNAIL_WIDTH, int(height * THUMBNAIL_WIDTH / width)))
+    success, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 80])
+    return buffer.tobytes() if success else None
+
+
+def not_modified(etag):
+    response = make_response('', 304)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, max-age=86400'
+    return response
+
+
+def create_history_blueprint(session_factory, Outfit, Item):
+    """Build the /outfits endpoints on top of the given session factory and models"""
+    history = Blueprint('history', __name__)
+
+    def load_history_version(Session, phone_id):
+        """Cheap fingerprint of a user's history: newest outfit id, outfit count and newest item id"""
+        max_outfit_id, outfit_count = (
+            Session.query(func.max(Outfit.id), func.count(Outfit.id)).filter(Outfit.phone_id == phone_id).one()
+        )
+        max_item_id = (
+            Session.query(func.max(Item.id))
+            .join(Outfit, Item.outfit_id == Outfit.id)
+            .filter(Outfit.phone_id == phone_id)
+            .scalar()
+        )
+        return f"{max_outfit_id}-{outfit_count}-{max_item_id}"
+
+    def load_outfit_history(phone_id, before, limit):
+        """
+        Load one page of a user's outfits and their items using keyset pagination on (phone_id, id).
+        Only the columns needed for the listing are selected, never Outfit.image_data.
+        """
+        Session = session_factory()
+        try:
+            query = Session.query(Outfit.id, Outfit.description).filter(Outfit.phone_id == phone_id)
+            if before is not None:
+                query = query.filter(Outfit.id < before)
+            # Fetch one extra row to know whether another page exists
+            outfits = query.order_by(Outfit.id.desc()).limit(limit + 1).all()
+            has_more = len(outfits) > limit
+            outfits = outfits[:limit]
+
+            items_by_outfit = {outfit.id: [] for outfit in outfits}
+            if outfits:
+                items = (
+                    Session.query(Item.id, Item.outfit_id, Item.description, Item.search)
+                    .filter(Item.outfit_id.in_(list(items_by_outfit)))
+                    .order_by(Item.id)
+                    .all()
+                )
+                for item in items:
+                    items_by_outfit[item.outfit_id].append({
+                        "id": item.id,
+                        "description": item.description,
+                        "search": item.search
+                    })
+
+            return {
+                "outfits": [
+                    {
+                        "id": outfit.id,
+                        "description": outfit.description,
+                        "thumbnail_url": url_for('history.outfit_thumbnail', outfit_id=outfit.id),
+                        "items": items_by_outfit[outfit.id]
+                    }
+                    for outfit in outfits
+                ],
+                "next_before": outfits[-1].id if has_more else None
+            }
+        finally:
+            Session.close()
+
+    @history.route("/outfits", methods=['GET'])
+    def outfit_history():
+        phone_id = authenticated_phone_id()
+        if phone_id is None:
+            return jsonify({'error': 'Unauthorized'}), 401
+        try:
+            before = request.args.get('before', type=int)
+            limit = min(max(int(request.args.get('limit', HISTORY_PAGE_SIZE)), 1), HISTORY_MAX_PAGE_SIZE)
+        except ValueError:
+            return jsonify({'error': 'Invalid pagination parameters'}), 400
+
+        Session = session_factory()
+        try:
+            version = load_history_version(Session, phone_id)
+        finally:
+            Session.close()
+
+        # The ETag depends only on the page and the history version, so a match is answered before loading the page
+        etag = hashlib.sha1(f"{phone_id}-{before}-{limit}-{version}".encode()).hexdigest()
+        if etag in request.if_none_match:
+            response = make_response('', 304)
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+
+        key = (before, limit)
+        payload = get_cached_history(phone_id, version, key)
+        if payload is None:
+            payload = load_outfit_history(phone_id, before, limit)
+            set_cached_history(phone_id, version, key, payload)
+
+        response = jsonify(payload)
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+
+    @history.route("/outfits/<int:outfit_id>/thumbnail", methods=['GET'])
+    def outfit_thumbnail(outfit_id):
+        phone_id = authenticated_phone_id()
+        if phone_id is None:
+            return jsonify({'error': 'Unauthorized'}), 401
+
+        # Stored images never change, so the ETag only depends on the outfit and thumbnail size
+        etag = hashlib.sha1(f"{outfit_id}-{THUMBNAIL_WIDTH}".encode()).hexdigest()
+        cached = get_cached_thumbnail(outfit_id)
+        if cached is not None:
+            owner_id, thumbnail = cached
+            # Only the caller's own outfits are served; others look the same as a missing outfit
+            if owner_id != phone_id:
+                return jsonify({'error': 'Outfit not found'}), 404
+            if etag in request.if_none_match:
+                return not_modified(etag)
+        else:
+            Session = session_factory()
+            try:
+                owner = Session.query(Outfit.phone_id).filter(Outfit.id == outfit_id).first()
+                if not owner or owner.phone_id != phone_id:
+                    return jsonify({'error': 'Outfit not found'}), 404
+                if etag in request.if_none_match:
+                    return not_modified(etag)
+                # The outfit may have been deleted since the ownership check
+                outfit = (
+                    Session.query(Outfit.image_data)
+                    .filter(Outfit.id == outfit_id, Outfit.phone_id == phone_id)
+                    .first()
+                )
+            finally:
+                Session.close()
+            if not outfit or not outfit.image_data:
+                return jsonify({'error': 'Outfit not found'}), 404
+
+            thumbnail = render_thumbnail(outfit.image_data)
+            if thumbnail is None:
+                return jsonify({'error': 'Unable to render thumbnail'}), 500
+            set_cached_thumbnail(outfit_id, phone_id, thumbnail)
+
+        response = make_response(thumbnail)
+        response.headers['Content-Type'] = 'image/jpeg'
+        response.headers['Cache-Control'] = 'private, max-age=86400'
+        response.set_etag(etag)
+        return response
+
+    return history
@@ -0,0 +1,147 @@
+# Local pre-filter that rejects obviously non-fashion images before the vision model
+import base64
+import os
+import sys
+
+import cv2
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Thresholds are tunable through the environment so they can be adjusted without a deploy
+# Off by default: the thresholds below are untuned until measured with `python prefilter.py <sample_dir>`,
+# and a false reject silently drops a real outfit
+PREFILTER_ENABLED = os.getenv('PREFILTER_ENABLED', 'false').lower() == 'true'
+PREFILTER_WIDTH = int(os.getenv('PREFILTER_WIDTH', 320))
+PREFILTER_MIN_CONTRAST = float(os.getenv('PREFILTER_MIN_CONTRAST', 12.0))  # grayscale std dev
+PREFILTER_MIN_SHARPNESS = float(os.getenv('PREFILTER_MIN_SHARPNESS', 40.0))  # variance of the Laplacian
+PREFILTER_MIN_EDGE_DENSITY = float(os.getenv('PREFILTER_MIN_EDGE_DENSITY', 0.02))  # fraction of Canny edge pixels
+PREFILTER_MAX_TEXT_COVERAGE = float(os.getenv('PREFILTER_MAX_TEXT_COVERAGE', 0.35))  # fraction covered by text-like blobs
+
+hog = cv2.HOGDescriptor()
+hog.setSVMDetector(cv2.HOGDescriptor_getDefaultPeopleDetector())
+
+
+def decode_base64_image(base64_image):
+    """Decode a base64 string (optionally a data URL) into a BGR frame, or None"""
+    try:
+        if base64_image.startswith('data:'):
+            base64_image = base64_image.split(',', 1)[1]
+        buffer = np.frombuffer(base64.b64decode(base64_image), dtype=np.uint8)
+        return cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+    except Exception as e:
+        print(f"Error decoding image for pre-filter: {e}")
+        return None
+
+
+def text_coverage(gray):
+    """Estimate the fraction of the frame covered by text-like regions"""
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3))
+    gradient = cv2.morphologyEx(gray, cv2.MORPH_GRADIENT, kernel)
+    _, binary = cv2.threshold(gradient, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
+    # Join characters on the same line into a single blob
+    line_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (9, 1))
+    connected = cv2.morphologyEx(binary, cv2.MORPH_CLOSE, line_kernel)
+    contours, _ = cv2.findContours(connected, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+    text_area = 0
+    for contour in contours:
+        x, y, w, h = cv2.boundingRect(contour)
+        if h < 6 or h > gray.shape[0] * 0.1 or w < h * 2:
+            continue
+        # Text lines are wide, short and densely filled
+        fill_ratio = cv2.countNonZero(binary[y:y + h, x:x + w]) / float(w * h)
+        if fill_ratio > 0.45:
+            text_area += w * h
+    return text_area / float(gray.shape[0] * gray.shape[1])
+
+
+def has_person(frame):
+    """Run the HOG people detector on a downscaled frame"""
+    rects, _ = hog.detectMultiScale(frame, winStride=(8, 8), padding=(8, 8), scale=1.05)
+    return len(rects) > 0
+
+
+def image_features(frame):
+    """Compute the cheap signals used by the pre-filter"""
+    height, width = frame.shape[:2]
+    if width > PREFILTER_WIDTH:
+        frame = cv2.resize(frame, (PREFILTER_WIDTH, int(height * PREFILTER_WIDTH / width)))
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    edges = cv2.Canny(gray, 100, 200)
+    return {
+        'contrast': float(gray.std()),
+        'sharpness': float(cv2.Laplacian(gray, cv2.CV_64F).var()),
+        'edge_density': cv2.countNonZero(edges) / float(edges.size),
+        'text_coverage': text_coverage(gray),
+        'frame': frame,
+    }
+
+
+def is_fashion_candidate(frame, enabled=None):
+    """
+    Return False for frames that are clearly not worth a vision call:
+    blank frames, blurry frames and text screenshots without a person in them.
+    enabled overrides PREFILTER_ENABLED for this call only.
+    """
+    if enabled is None:
+        enabled = PREFILTER_ENABLED
+    if not enabled or frame is None:
+        return True
+
+    features = image_features(frame)
+    if features['contrast'] < PREFILTER_MIN_CONTRAST:
+        return False
+    if features['sharpness'] < PREFILTER_MIN_SHARPNESS:
+        return False
+    if features['edge_density'] < PREFILTER_MIN_EDGE_DENSITY:
+        return False
+    # Screenshots of TikToks and Reels carry overlay text, so only reject text-heavy frames without a person
+    if features['text_coverage'] > PREFILTER_MAX_TEXT_COVERAGE and not has_person(features['frame']):
+        return False
+    return True
+
+
+def is_fashion_candidate_base64(base64_image):
+    """Like is_fashion_candidate, but only decodes the image when the pre-filter is enabled"""
+    if not PREFILTER_ENABLED:
+        return True
+    return is_fashion_candidate(decode_base64_image(base64_image))
+
+
+def evaluate(sample_dir):
+    """
+    Report precision/recall of the pre-filter on a labelled sample set.
+    Expects sample_dir/fashion/* (should pass) and sample_dir/reject/* (should be rejected).
+    Precision/recall are computed for the "reject" class, since a false reject loses a real outfit.
+    """
+    true_reject = false_reject = missed_reject = 0
+    for label in ('fashion', 'reject'):
+        label_dir = os.path.join(sample_dir, label)
+        for name in sorted(os.listdir(label_dir)):
+            frame = cv2.imread(os.path.join(label_dir, name))
+            if frame is None:
+                continue
+            # Measure the heuristics themselves, whatever PREFILTER_ENABLED is set to
+            rejected = not is_fashion_candidate(frame, enabled=True)
+            if rejected and label == 'reject':
+                true_reject += 1
+            elif rejected:
+                false_reject += 1
+                print(f"False reject: {label}/{name}")
+            elif label == 'reject':
+                missed_reject += 1
+
+    precision = true_reject / float(true_reject + false_reject) if true_reject + false_reject else 0.0
+    recall = true_reject / float(true_reject + missed_reject) if true_reject + missed_reject else 0.0
+    print(f"Rejected correctly: {true_reject}, wrongly: {false_reject}, missed: {missed_reject}")
+    print(f"Precision: {precision:.3f}, Recall: {recall:.3f}")
+    return precision, recall
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print("Usage: python prefilter.py <sample_dir>")
+        sys.exit(1)
+    evaluate(sys.argv[1])
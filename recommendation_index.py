@@ -0,0 +1,259 @@
+# In-process nearest-neighbour index over catalog item embeddings, used before the remote rag_search
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+
+RECOMMENDATION_INDEX_DIR = os.getenv('RECOMMENDATION_INDEX_DIR')
+RECOMMENDATION_MIN_SCORE = float(os.getenv('RECOMMENDATION_MIN_SCORE', 0.5))  # cosine similarity
+RECOMMENDATION_NPROBE = int(os.getenv('RECOMMENDATION_NPROBE', 8))
+RECOMMENDATION_RELOAD_INTERVAL = float(os.getenv('RECOMMENDATION_RELOAD_INTERVAL', 30))
+
+# Snapshot layout (written by build_snapshot); every snapshot lives in its own directory and is never modified:
+# - <directory>/embeddings.npy   float32 (N, D), L2-normalised, memory-mapped read-only
+# - <directory>/item_ids.npy     (N,) catalog item ids, same order as embeddings
+# - <directory>/centroids.npy    optional float32 (L, D) IVF centroids; embeddings are then sorted by list
+# - <directory>/list_offsets.npy optional int64 (L + 1,) start of each IVF list in embeddings
+# - manifest.json                {"model", "version", "count", "directory"}, atomically replaced to publish a snapshot
+
+def read_manifest(path):
+    with open(os.path.join(path, 'manifest.json')) as f:
+        return json.load(f)
+
+
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class VectorIndex:
+    """Brute-force or IVF cosine search over one memory-mapped snapshot"""
+
+    def __init__(self, path, manifest=None):
+        self.manifest = manifest or read_manifest(path)
+        snapshot_path = os.path.join(path, self.manifest['directory'])
+        self.embeddings = np.load(os.path.join(snapshot_path, 'embeddings.npy'), mmap_mode='r')
+        self.item_ids = np.load(os.path.join(snapshot_path, 'item_ids.npy'))
+        self.centroids = None
+        self.list_offsets = None
+        if os.path.exists(os.path.join(snapshot_path, 'centroids.npy')):
+            self.centroids = np.load(os.path.join(snapshot_path, 'centroids.npy'))
+            self.list_offsets = np.load(os.path.join(snapshot_path, 'list_offsets.npy'))
+
+        if len(self.embeddings) != len(self.item_ids) or self.manifest['count'] != len(self.item_ids):
+            raise ValueError(f"Inconsistent recommendation snapshot at {snapshot_path}")
+
+    @property
+    def model(self):
+        return self.manifest['model']
+
+    @property
+    def version(self):
+        return self.manifest.get('version')
+
+    def search(self, queries, k=1, nprobe=RECOMMENDATION_NPROBE):
+        """Return (item_ids, scores) arrays of shape (len(queries), k) for normalised query vectors"""
+        queries = normalize(queries)
+        if self.centroids is None:
+            return self.top_k(queries @ self.embeddings.T, np.arange(len(self.item_ids)), k)
+
+        # IVF: only score the embeddings in the nprobe closest lists of each query
+        probes = np.argsort(-(queries @ self.centroids.T), axis=1)[:, :nprobe]
+        ids, scores = [], []
+        for query, lists in zip(queries, probes):
+            rows = np.concatenate([np.arange(self.list_offsets[l], self.list_offsets[l + 1]) for l in lists])
+            if len(rows) < k:
+                rows = np.arange(len(self.item_ids))
+            query_ids, query_scores = self.top_k(query[None, :] @ self.embeddings[rows].T, rows, k)
+            ids.append(query_ids[0])
+            scores.append(query_scores[0])
+        return np.array(ids), np.array(scores)
+
+    def top_k(self, scores, rows, k):
+        k = min(k, scores.shape[1])
+        if k == 0:
+            return np.empty((len(scores), 0), dtype=self.item_ids.dtype), np.empty((len(scores), 0), dtype=np.float32)
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+        return self.item_ids[rows[top]], np.take_along_axis(top_scores, order, axis=1)
+
+
+class RecommendationIndex:
+    """
+    Keeps the current VectorIndex and swaps in a new one when the snapshot's manifest changes.
+    Lookups never block on a reload: only the first snapshot is loaded inline, later ones are loaded
+    in a background thread while lookups keep using the previous snapshot.
+    """
+
+    def __init__(self, path, embed, min_score=RECOMMENDATION_MIN_SCORE, reload_interval=RECOMMENDATION_RELOAD_INTERVAL):
+        self.path = path
+        self.embed = embed  # callable(model, texts) -> list of vectors
+        self.min_score = min_score
+        self.reload_interval = reload_interval
+        self.index = None
+        self.checked_at = 0
+        self.lock = threading.Lock()  # held from the manifest check until a reload finishes
+        self.maybe_reload(force=True)
+
+    def maybe_reload(self, force=False):
+        if not self.path or (not force and time.monotonic() - self.checked_at < self.reload_interval):
+            return
+        if not self.lock.acquire(blocking=False):
+            return
+        try:
+            self.checked_at = time.monotonic()
+            manifest = read_manifest(self.path)
+            if self.index is not None and manifest['directory'] == self.index.manifest['directory']:
+                manifest = None
+        except Exception as e:
+            print(f"Error reading recommendation manifest: {e}")
+            manifest = None
+
+        if manifest is None:
+            self.lock.release()
+        elif self.index is None:
+            # Nothing to serve yet, so there is no previous snapshot to fall back on
+            self.load(manifest)
+        else:
+            threading.Thread(target=self.load, args=(manifest,), name="recommendation-reload", daemon=True).start()
+
+    def load(self, manifest):
+        """Open the snapshot named by manifest and swap it in, then release the reload lock"""
+        try:
+            self.index = VectorIndex(self.path, manifest)
+            print(f"Loaded recommendation snapshot {self.index.version} with {len(self.index.item_ids)} items")
+        except Exception as e:
+            print(f"Error loading recommendation snapshot: {e}")
+        finally:
+            self.lock.release()
+
+    def lookup(self, item_descriptions):
+        """
+        Return one item id per description, or None where there is no confident local match
+        (no snapshot, embedding failure or best score below min_score)
+        """
+        self.maybe_reload()
+        index = self.index
+        if index is None or not item_descriptions:
+            return [None] * len(item_descriptions)
+        try:
+            ids, scores = index.search(self.embed(index.model, item_descriptions), k=1)
+        except Exception as e:
+            print(f"Error searching recommendation index: {e}")
+            return [None] * len(item_descriptions)
+        return [
+            ids[row, 0].item() if scores.shape[1] and scores[row, 0] >= self.min_score else None
+            for row in range(len(item_descriptions))
+        ]
+
+
+def kmeans(vectors, n_lists, iterations=10, seed=0):
+    """Spherical k-means used to build IVF lists; n_lists is capped at the number of vectors"""
+    n_lists = min(n_lists, len(vectors))
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), n_lists, replace=False)]
+    for _ in range(iterations):
+        assignments = np.argmax(vectors @ centroids.T, axis=1)
+        for l in range(n_lists):
+            members = vectors[assignments == l]
+            if len(members):
+                centroids[l] = members.mean(axis=0)
+        centroids = normalize(centroids)
+    return centroids, np.argmax(vectors @ centroids.T, axis=1)
+
+
+def build_snapshot(path, embeddings, item_ids, model, version, n_lists=0, keep=2):
+    """
+    Write a snapshot into a new directory and publish it by replacing manifest.json.
+    With n_lists > 0 the embeddings are grouped into IVF lists.
+    Only the newest `keep` snapshot directories are kept; readers still mapping an older one keep its files.
+    """
+    embeddings = normalize(embeddings)
+    item_ids = np.asarray(item_ids)
+    directory = f"snapshot-{version}-{int(time.time() * 1000)}"
+    snapshot_path = os.path.join(path, directory)
+    os.makedirs(snapshot_path)
+
+    if n_lists:
+        centroids, assignments = kmeans(embeddings, n_lists)
+        n_lists = len(centroids)
+        order = np.argsort(assignments, kind='stable')
+        embeddings, item_ids = embeddings[order], item_ids[order]
+        list_offsets = np.searchsorted(assignments[order], np.arange(n_lists + 1)).astype(np.int64)
+        np.save(os.path.join(snapshot_path, 'centroids.npy'), centroids)
+        np.save(os.path.join(snapshot_path, 'list_offsets.npy'), list_offsets)
+    np.save(os.path.join(snapshot_path, 'embeddings.npy'), embeddings)
+    np.save(os.path.join(snapshot_path, 'item_ids.npy'), item_ids)
+
+    temp_manifest = os.path.join(path, '.manifest.json.tmp')
+    with open(temp_manifest, 'w') as f:
+        json.dump({'model': model, 'version': version, 'count': len(item_ids), 'directory': directory}, f)
+    os.replace(temp_manifest, os.path.join(path, 'manifest.json'))
+
+    snapshots = sorted(
+        (name for name in os.listdir(path) if name.startswith('snapshot-')),
+        key=lambda name: os.path.getmtime(os.path.join(path, name)),
+    )
+    for name in snapshots[:-keep]:
+        if name != directory:
+            shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+
+
+def recall_benchmark(path, queries_file, remote_lookup, embed, k=5):
+    """
+    Compare local results with the remote rag_search for every line of queries_file:
+    recall@1 / recall@k is the fraction of queries whose remote item id is in the local top 1 / top k
+    """
+    index = VectorIndex(path)
+    with open(queries_file) as f:
+        queries = [line.strip() for line in f if line.strip()]
+
+    vectors = normalize(embed(index.model, queries))
+    start = time.perf_counter()
+    local_ids, _ = index.search(vectors, k=k)
+    search_ms = (time.perf_counter() - start) * 1000 / len(queries)
+
+    hits_at_1 = hits_at_k = compared = 0
+    for query, ids in zip(queries, local_ids):
+        remote_id = remote_lookup(query)
+        if remote_id is None:
+            continue
+        compared += 1
+        ids = [item_id.item() for item_id in ids]
+        hits_at_1 += str(ids[0]) == str(remote_id)
+        hits_at_k += str(remote_id) in [str(item_id) for item_id in ids]
+
+    print(f"Compared {compared} of {len(queries)} queries against the remote service")
+    if compared:
+        print(f"Recall@1: {hits_at_1 / compared:.3f}, Recall@{k}: {hits_at_k / compared:.3f}")
+    print(f"Local search: {search_ms:.3f}ms per query (batched)")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print("Usage: python recommendation_index.py <snapshot_dir> <queries_file>")
+        sys.exit(1)
+
+    import requests
+    from openai import OpenAI
+
+    client = OpenAI()
+
+    def embed(model, texts):
+        return [item.embedding for item in client.embeddings.create(model=model, input=texts).data]
+
+    def remote_lookup(item_description):
+        response = requests.post("https://access.wha7.com/rag_search", json={"item_description": item_description}, timeout=10)
+        return response.json()["item_id"] if response.status_code == 200 else None
+
+    recall_benchmark(sys.argv[1], sys.argv[2], remote_lookup, embed)
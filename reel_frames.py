@@ -0,0 +1,248 @@
+# CPU-bound reel frame extraction, run in a dedicated process pool so it does not hold the GIL
+# of the gunicorn worker that is serving other requests
+import base64
+import fcntl
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+import cv2
+import numpy as np
+from dotenv import load_dotenv
+from skimage.metrics import structural_similarity as ssim
+
+from prefilter import is_fashion_candidate
+
+load_dotenv()
+
+REEL_PROCESS_WORKERS = int(os.getenv('REEL_PROCESS_WORKERS', 2))
+REEL_MAX_HOST_DECODES = int(os.getenv('REEL_MAX_HOST_DECODES', 2))  # shared by every worker on the host
+REEL_DECODE_WAIT = float(os.getenv('REEL_DECODE_WAIT', 60))
+REEL_DECODE_TIMEOUT = float(os.getenv('REEL_DECODE_TIMEOUT', 120))  # longest a single reel may hold a decode slot
+REEL_LOCK_DIR = os.getenv('REEL_LOCK_DIR', tempfile.gettempdir())
+
+reel_pool = None
+reel_pool_lock = threading.Lock()
+
+
+class ReelBusyError(Exception):
+    """Raised when no decode slot frees up on this host in time"""
+
+
+class ReelTimeoutError(Exception):
+    """Raised when decoding a reel takes longer than REEL_DECODE_TIMEOUT"""
+
+
+def resize_frame_with_aspect_ratio(frame, target_width=640):
+    """
+    Resize frame while maintaining aspect ratio
+    """
+    height, width = frame.shape[:2]
+    aspect_ratio = width / height
+    target_height = int(target_width / aspect_ratio)
+    return cv2.resize(frame, (target_width, target_height))
+
+
+def unique_frames_from_video(video_path, max_unique_frames=5, similarity_threshold=0.80, max_frames=300):
+    """
+    Decode a video and return up to max_unique_frames visually distinct frames as base64 JPEGs,
+    or None if the video could not be opened.
+    Runs inside the reel pool, so only the path goes in and compressed JPEGs come back;
+    decoded frames never cross the process boundary.
+    """
+    video = cv2.VideoCapture(video_path)
+    try:
+        if not video.isOpened():
+            return None
+
+        fps = min(video.get(cv2.CAP_PROP_FPS), 30)
+        total_frames = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+        max_frames_to_process = min(total_frames, max_frames)
+        frame_interval = max(int(fps * 2), 1)
+
+        unique_frames = []
+        previous_frame = None
+        frame_count = 0
+
+        while frame_count < max_frames_to_process and len(unique_frames) < max_unique_frames:
+            # grab() skips colour conversion for the frames we are not going to look at
+            if frame_count % frame_interval != 0:
+                if not video.grab():
+                    break
+                frame_count += 1
+                continue
+
+            ret, frame = video.read()
+            if not ret:
+                break
+
+            if is_fashion_candidate(frame):
+                # Resize for comparison while maintaining aspect ratio
+                processing_frame = resize_frame_with_aspect_ratio(frame, target_width=640)
+                gray_frame = cv2.cvtColor(processing_frame, cv2.COLOR_BGR2GRAY)
+
+                is_unique = True
+                if previous_frame is not None:
+                    if previous_frame.shape != gray_frame.shape:
+                        gray_frame = cv2.resize(gray_frame, previous_frame.shape[::-1])
+                    similarity = ssim(previous_frame, gray_frame)
+                    is_unique = similarity < similarity_threshold
+
+                if is_unique:
+                    # Store original frame (not the resized version) in base64
+                    success, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 95])
+                    if success:
+                        unique_frames.append(base64.b64encode(buffer).decode('utf-8'))
+                        previous_frame = gray_frame
+
+            frame_count += 1
+        return unique_frames
+    finally:
+        video.release()
+
+
+def init_reel_process():
+    # One OpenCV thread per process; the pool size already bounds parallelism
+    cv2.setNumThreads(1)
+
+
+def get_reel_pool():
+    """Create the pool lazily so it is started after gunicorn forks the worker"""
+    global reel_pool
+    with reel_pool_lock:
+        if reel_pool is None:
+            # spawn rather than fork: forking a threaded worker can copy held locks into the child
+            reel_pool = ProcessPoolExecutor(
+                max_workers=REEL_PROCESS_WORKERS,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=init_reel_process,
+            )
+        return reel_pool
+
+
+class host_decode_slot:
+    """
+    Host-wide cap on concurrent reel decodes, shared across gunicorn workers
+    through advisory locks on REEL_MAX_HOST_DECODES slot files
+    """
+
+    def __init__(self, timeout=REEL_DECODE_WAIT):
+        self.timeout = timeout
+        self.lock_file = None
+
+    def __enter__(self):
+        deadline = time.monotonic() + self.timeout
+        while True:
+            for slot in range(REEL_MAX_HOST_DECODES):
+                lock_file = open(os.path.join(REEL_LOCK_DIR, f"wha7-reel-slot-{slot}.lock"), 'w')
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    self.lock_file = lock_file
+                    return self
+                except BlockingIOError:
+                    lock_file.close()
+            if time.monotonic() > deadline:
+                raise ReelBusyError("No reel decode slot available")
+            time.sleep(0.1)
+
+    def __exit__(self, *exc):
+        fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+        self.lock_file.close()
+
+
+def reset_reel_pool(pool, terminate=False):
+    """
+    Drop a pool that can no longer be used so the next call starts a fresh one: either a child died
+    (e.g. OpenCV crashing on a malformed video) or, with terminate, a child is stuck and is killed
+    """
+    global reel_pool
+    with reel_pool_lock:
+        if reel_pool is pool:
+            reel_pool = None
+    if terminate:
+        # ProcessPoolExecutor has no public way to kill a busy worker
+        for process in list((pool._processes or {}).values()):
+            process.terminate()
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def run_in_reel_pool(fn, *args, timeout=REEL_DECODE_TIMEOUT, **kwargs):
+    """
+    Run fn in the reel pool while holding a host decode slot.
+    The slot is released on every exit path, including a stuck child being killed after timeout.
+    """
+    with host_decode_slot():
+        for attempt in range(2):
+            pool = get_reel_pool()
+            future = pool.submit(fn, *args, **kwargs)
+            try:
+                return future.result(timeout=timeout)
+            except FutureTimeoutError:
+                reset_reel_pool(pool, terminate=True)
+                raise ReelTimeoutError(f"Reel processing exceeded {timeout:.0f}s")
+            except BrokenProcessPool:
+                # Reset even on the final attempt so a video that crashes twice does not break later reels
+                reset_reel_pool(pool)
+                if attempt == 1:
+                    raise
+                print("Reel process pool broke, restarting it and retrying once")
+
+
+def extract_reel_frames(video_path, **kwargs):
+    """Run unique_frames_from_video in the reel pool, waiting for a host decode slot first"""
+    return run_in_reel_pool(unique_frames_from_video, video_path, **kwargs)
+
+
+def benchmark(reels=4, duration=10, probe_interval=0.005):
+    """
+    Measure request-thread latency while several reels are processed,
+    once inline in threads (the old behaviour) and once through the reel pool
+    """
+    with tempfile.NamedTemporaryFile(suffix='.mp4', delete=False) as temp_file:
+        video_path = temp_file.name
+    writer = cv2.VideoWriter(video_path, cv2.VideoWriter_fourcc(*'mp4v'), 30, (1080, 1920))
+    rng = np.random.default_rng(0)
+    for idx in range(30 * duration):
+        # New scene every second so SSIM keeps finding distinct frames
+        if idx % 30 == 0:
+            scene = rng.integers(0, 255, (1920, 1080, 3), dtype=np.uint8)
+        writer.write(scene)
+    writer.release()
+
+    def probe(stop, delays):
+        # Stand-in for another request thread: how late does it wake up?
+        while not stop.is_set():
+            start = time.perf_counter()
+            time.sleep(probe_interval)
+            delays.append(time.perf_counter() - start - probe_interval)
+
+    def run(label, fn):
+        stop, delays = threading.Event(), []
+        prober = threading.Thread(target=probe, args=(stop, delays))
+        prober.start()
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=reels) as executor:
+            list(executor.map(lambda _: fn(video_path, max_unique_frames=10), range(reels)))
+        elapsed = time.perf_counter() - start
+        stop.set()
+        prober.join()
+        delays.sort()
+        p50 = delays[len(delays) // 2] * 1000
+        p99 = delays[int(len(delays) * 0.99)] * 1000
+        print(f"{label}: {reels} reels in {elapsed:.2f}s, request-thread delay p50 {p50:.2f}ms p99 {p99:.2f}ms max {delays[-1] * 1000:.2f}ms")
+
+    try:
+        get_reel_pool().submit(init_reel_process).result()  # warm up the pool
+        run("inline threads", unique_frames_from_video)
+        run("reel pool", extract_reel_frames)
+    finally:
+        os.unlink(video_path)
+
+
+if __name__ == '__main__':
+    benchmark(reels=int(sys.argv[1]) if len(sys.argv) > 1 else 4)
@@ -0,0 +1,185 @@
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from model_calls import CircuitOpenError, ModelCallError, ModelEndpoint
+
+
+class BadRequest(Exception):
+    pass
+
+
+class ServerError(Exception):
+    pass
+
+
+RETRYABLE = (TimeoutError, ConnectionError, ServerError)
+
+
+class FakeUpstream(ThreadingHTTPServer):
+    """Local HTTP server with injectable latency and status codes"""
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), FakeHandler)
+        self.latency = 0.0
+        self.status = 200
+        self.latencies = []  # per-request overrides, consumed in order
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def next_response(self):
+        with self.lock:
+            self.requests += 1
+            latency = self.latencies.pop(0) if self.latencies else self.latency
+        return latency, self.status
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        latency, status = self.server.next_response()
+        time.sleep(latency)
+        self.send_response(status)
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def upstream():
+    server = FakeUpstream()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def client(server):
+    url = f"http://127.0.0.1:{server.server_address[1]}/"
+
+    def fn(timeout):
+        try:
+            with urllib.request.urlopen(url, timeout=timeout) as response:
+                return response.read()
+        except urllib.error.HTTPError as e:
+            if e.code >= 500:
+                raise ServerError(e.code)
+            raise BadRequest(e.code)
+    return fn
+
+
+def endpoint(**kwargs):
+    kwargs.setdefault('backoff_base', 0)
+    kwargs.setdefault('retryable', RETRYABLE)
+    return ModelEndpoint("test", **kwargs)
+
+
+def prime(model_endpoint, latency, samples=20):
+    model_endpoint.latencies.extend([latency] * samples)
+
+
+def test_call_returns_upstream_result(upstream):
+    assert endpoint(deadline=1).call(client(upstream)) == b'ok'
+
+
+def test_deadline_is_enforced(upstream):
+    upstream.latency = 1.0
+    start = time.monotonic()
+    with pytest.raises(ModelCallError):
+        endpoint(deadline=0.3, max_attempts=1).call(client(upstream))
+    assert time.monotonic() - start < 0.8
+
+
+def test_concurrent_callers_within_deadline_all_succeed(upstream):
+    upstream.latency = 0.3
+    model_endpoint = endpoint(deadline=1, failure_threshold=1)
+    fn = client(upstream)
+    with ThreadPoolExecutor(max_workers=24) as callers:
+        results = list(callers.map(lambda _: model_endpoint.call(fn), range(24)))
+    assert results == [b'ok'] * 24
+    assert model_endpoint.breaker.allow()
+
+
+def test_hedge_fires_after_p95(upstream):
+    model_endpoint = endpoint(deadline=2, hedge=True)
+    prime(model_endpoint, 0.05)
+    upstream.latencies = [1.0, 0.0]
+    start = time.monotonic()
+    assert model_endpoint.call(client(upstream)) == b'ok'
+    assert time.monotonic() - start < 0.5
+    assert upstream.requests == 2
+
+
+def test_no_hedge_before_enough_samples(upstream):
+    model_endpoint = endpoint(deadline=2, hedge=True)
+    upstream.latency = 0.2
+    model_endpoint.call(client(upstream))
+    assert upstream.requests == 1
+
+
+def test_queued_hedge_is_dropped_when_caller_gives_up(upstream):
+    # One executor thread, so the hedge queues behind the slow primary
+    model_endpoint = endpoint(deadline=0.3, max_attempts=1, hedge=True, max_workers=1)
+    prime(model_endpoint, 0.05)
+    upstream.latency = 0.6
+    with pytest.raises(ModelCallError):
+        model_endpoint.call(client(upstream))
+    time.sleep(0.8)
+    assert upstream.requests == 1
+
+
+def test_retries_retryable_errors(upstream):
+    upstream.status = 500
+    with pytest.raises(ModelCallError):
+        endpoint(deadline=2, max_attempts=3).call(client(upstream))
+    assert upstream.requests == 3
+
+
+def test_bad_request_is_not_retried_or_counted(upstream):
+    upstream.status = 400
+    model_endpoint = endpoint(deadline=2, max_attempts=3, failure_threshold=2)
+    fn = client(upstream)
+    for _ in range(5):
+        with pytest.raises(BadRequest):
+            model_endpoint.call(fn)
+    assert upstream.requests == 5
+
+    upstream.status = 200
+    assert model_endpoint.call(fn) == b'ok'
+
+
+def test_breaker_opens_half_opens_and_closes(upstream):
+    model_endpoint = endpoint(deadline=2, max_attempts=1, failure_threshold=2, reset_timeout=0.2)
+    fn = client(upstream)
+    upstream.status = 500
+    for _ in range(2):
+        with pytest.raises(ModelCallError):
+            model_endpoint.call(fn)
+
+    # Open: fails fast without calling upstream
+    with pytest.raises(CircuitOpenError):
+        model_endpoint.call(fn)
+    assert upstream.requests == 2
+
+    # Half-open: a failed trial reopens the circuit
+    time.sleep(0.25)
+    with pytest.raises(ModelCallError):
+        model_endpoint.call(fn)
+    with pytest.raises(CircuitOpenError):
+        model_endpoint.call(fn)
+    assert upstream.requests == 3
+
+    # Half-open: a successful trial closes it again
+    time.sleep(0.25)
+    upstream.status = 200
+    assert model_endpoint.call(fn) == b'ok'
+    assert model_endpoint.call(fn) == b'ok'
@@ -0,0 +1,144 @@
+import base64
+
+import cv2
+import numpy as np
+import pytest
+from flask import Flask
+from sqlalchemy import Column, ForeignKey, Integer, String, Text, create_engine
+from sqlalchemy.orm import declarative_base, sessionmaker
+
+import outfit_history
+
+Base = declarative_base()
+
+
+class Outfit(Base):
+    __tablename__ = 'outfits'
+    id = Column(Integer, primary_key=True)
+    phone_id = Column(Integer, index=True)
+    image_data = Column(Text)
+    description = Column(String)
+
+
+class Item(Base):
+    __tablename__ = 'items'
+    id = Column(Integer, primary_key=True)
+    outfit_id = Column(Integer, ForeignKey('outfits.id'))
+    description = Column(String)
+    search = Column(String)
+
+
+def image_data(width=800, height=600):
+    frame = np.full((height, width, 3), 128, dtype=np.uint8)
+    _, buffer = cv2.imencode('.jpg', frame)
+    return f"data:image/jpeg;base64,{base64.b64encode(buffer).decode('utf-8')}"
+
+
+@pytest.fixture
+def history(monkeypatch):
+    monkeypatch.setattr(outfit_history, 'HISTORY_TOKEN_SECRET', 'test-secret')
+    outfit_history.history_cache.clear()
+    outfit_history.thumbnail_cache.clear()
+
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    session_factory = sessionmaker(bind=engine)
+
+    Session = session_factory()
+    for phone_id in (1, 2):
+        for idx in range(5):
+            outfit = Outfit(phone_id=phone_id, image_data=image_data(), description=f"Outfit {idx}")
+            Session.add(outfit)
+            Session.flush()
+            Session.add(Item(outfit_id=outfit.id, description=f"Item {idx}", search=f"search {idx}"))
+    Session.commit()
+    Session.close()
+
+    app = Flask(__name__)
+    app.register_blueprint(outfit_history.create_history_blueprint(session_factory, Outfit, Item))
+    return app.test_client(), session_factory
+
+
+def auth(phone_id):
+    return {'Authorization': f"Bearer {outfit_history.issue_history_token(phone_id)}"}
+
+
+def test_token_reads_pages(history):
+    client, _ = history
+    first = client.get('/outfits?limit=3', headers=auth(1))
+    assert first.status_code == 200
+    page = first.get_json()
+    assert [outfit['description'] for outfit in page['outfits']] == ['Outfit 4', 'Outfit 3', 'Outfit 2']
+    assert page['outfits'][0]['items'][0]['search'] == 'search 4'
+    assert 'image_data' not in page['outfits'][0]
+
+    second = client.get(f"/outfits?limit=3&before={page['next_before']}", headers=auth(1)).get_json()
+    assert [outfit['description'] for outfit in second['outfits']] == ['Outfit 1', 'Outfit 0']
+    assert second['next_before'] is None
+
+
+def test_requests_without_valid_token_are_rejected(history):
+    client, _ = history
+    assert client.get('/outfits').status_code == 401
+    assert client.get('/outfits', headers={'Authorization': 'Bearer 1.9999999999.bad'}).status_code == 401
+    expired = outfit_history.issue_history_token(1, ttl=-1)
+    assert client.get('/outfits', headers={'Authorization': f"Bearer {expired}"}).status_code == 401
+
+
+def test_no_token_without_secret(monkeypatch):
+    monkeypatch.setattr(outfit_history, 'HISTORY_TOKEN_SECRET', None)
+    assert outfit_history.issue_history_token(1) is None
+
+
+def test_etag_changes_when_history_changes(history):
+    client, session_factory = history
+    first = client.get('/outfits', headers=auth(1))
+    etag = first.headers['ETag']
+    assert client.get('/outfits', headers={**auth(1), 'If-None-Match': etag}).status_code == 304
+
+    # A commit from another worker never invalidates this worker's cache, but changes the version
+    Session = session_factory()
+    Session.add(Outfit(phone_id=1, image_data=image_data(), description="Outfit new"))
+    Session.commit()
+    Session.close()
+
+    fresh = client.get('/outfits', headers={**auth(1), 'If-None-Match': etag})
+    assert fresh.status_code == 200
+    assert fresh.get_json()['outfits'][0]['description'] == 'Outfit new'
+
+
+def test_thumbnail_is_small_private_and_owner_only(history):
+    client, _ = history
+    page = client.get('/outfits', headers=auth(1)).get_json()
+    url = page['outfits'][0]['thumbnail_url']
+
+    response = client.get(url, headers=auth(1))
+    assert response.status_code == 200
+    assert response.headers['Content-Type'] == 'image/jpeg'
+    assert response.headers['Cache-Control'].startswith('private')
+    thumbnail = cv2.imdecode(np.frombuffer(response.data, np.uint8), cv2.IMREAD_COLOR)
+    assert thumbnail.shape[1] == outfit_history.THUMBNAIL_WIDTH
+
+    assert client.get(url, headers=auth(2)).status_code == 404
+    assert client.get(f"{url}?token={outfit_history.issue_history_token(1)}").status_code == 200
+
+
+def test_thumbnail_is_served_from_cache_without_loading_the_image(history):
+    client, session_factory = history
+    Session = session_factory()
+    outfit = Session.query(Outfit).filter(Outfit.phone_id == 1).first()
+    outfit_history.store_thumbnail(outfit.id, 1, outfit.image_data)
+    # Once cached, the stored image is never read again
+    outfit.image_data = None
+    Session.commit()
+    outfit_id = outfit.id
+    Session.close()
+
+    response = client.get(f"/outfits/{outfit_id}/thumbnail", headers=auth(1))
+    assert response.status_code == 200
+    assert client.get(f"/outfits/{outfit_id}/thumbnail", headers=auth(2)).status_code == 404
+
+
+def test_missing_outfit_thumbnail_is_not_found(history):
+    client, _ = history
+    assert client.get('/outfits/9999/thumbnail', headers=auth(1)).status_code == 404
@@ -0,0 +1,32 @@
+import cv2
+import numpy as np
+
+import prefilter
+
+
+def test_blank_frame_is_rejected_only_when_enabled():
+    blank = np.zeros((480, 640, 3), dtype=np.uint8)
+    assert prefilter.is_fashion_candidate(blank, enabled=True) is False
+    assert prefilter.is_fashion_candidate(blank, enabled=False) is True
+
+
+def test_disabled_filter_does_not_decode(monkeypatch):
+    def fail_decode(base64_image):
+        raise AssertionError("image was decoded")
+
+    monkeypatch.setattr(prefilter, 'PREFILTER_ENABLED', False)
+    monkeypatch.setattr(prefilter, 'decode_base64_image', fail_decode)
+    assert prefilter.is_fashion_candidate_base64("not even base64") is True
+
+
+def test_evaluate_measures_with_filter_disabled(tmp_path, monkeypatch):
+    monkeypatch.setattr(prefilter, 'PREFILTER_ENABLED', False)
+    (tmp_path / 'fashion').mkdir()
+    (tmp_path / 'reject').mkdir()
+    rng = np.random.default_rng(0)
+    cv2.imwrite(str(tmp_path / 'fashion' / 'busy.png'), rng.integers(0, 255, (480, 640, 3), dtype=np.uint8))
+    cv2.imwrite(str(tmp_path / 'reject' / 'blank.png'), np.zeros((480, 640, 3), dtype=np.uint8))
+
+    precision, recall = prefilter.evaluate(str(tmp_path))
+    assert recall == 1.0
+    assert prefilter.PREFILTER_ENABLED is False
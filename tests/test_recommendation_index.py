@@ -0,0 +1,100 @@
+import os
+
+import numpy as np
+import pytest
+
+from recommendation_index import RecommendationIndex, VectorIndex, build_snapshot, kmeans, normalize, read_manifest
+
+
+def synthetic_embeddings(count=300, dim=16, seed=0):
+    return normalize(np.random.default_rng(seed).normal(size=(count, dim)))
+
+
+def test_ivf_matches_brute_force_when_probing_every_list(tmp_path):
+    embeddings = synthetic_embeddings()
+    item_ids = np.arange(1000, 1000 + len(embeddings))
+    queries = synthetic_embeddings(20, seed=1)
+
+    flat_path, ivf_path = tmp_path / 'flat', tmp_path / 'ivf'
+    flat_path.mkdir()
+    ivf_path.mkdir()
+    build_snapshot(str(flat_path), embeddings, item_ids, 'test-model', 'v1')
+    build_snapshot(str(ivf_path), embeddings, item_ids, 'test-model', 'v1', n_lists=8)
+
+    flat_ids, flat_scores = VectorIndex(str(flat_path)).search(queries, k=5)
+    ivf_ids, ivf_scores = VectorIndex(str(ivf_path)).search(queries, k=5, nprobe=8)
+    assert (flat_ids == ivf_ids).all()
+    assert np.allclose(flat_scores, ivf_scores, atol=1e-5)
+
+    # The exact nearest neighbour is what brute force reports
+    expected = item_ids[np.argmax(queries @ embeddings.T, axis=1)]
+    assert (flat_ids[:, 0] == expected).all()
+
+
+def test_ivf_falls_back_to_all_rows_when_probed_lists_are_too_small(tmp_path):
+    embeddings = synthetic_embeddings(60)
+    item_ids = np.arange(len(embeddings))
+    build_snapshot(str(tmp_path), embeddings, item_ids, 'test-model', 'v1', n_lists=30)
+    index = VectorIndex(str(tmp_path))
+    queries = synthetic_embeddings(5, seed=1)
+
+    ids, scores = index.search(queries, k=10, nprobe=1)
+    assert ids.shape == (5, 10)
+    expected = np.argsort(-(queries @ embeddings.T), axis=1)[:, :10]
+    assert (ids == expected).all()
+    assert (np.diff(scores, axis=1) <= 1e-6).all()
+
+
+def test_kmeans_clamps_lists_to_vector_count(tmp_path):
+    embeddings = synthetic_embeddings(3)
+    centroids, assignments = kmeans(embeddings, 10)
+    assert len(centroids) == 3
+    assert assignments.max() < 3
+
+    build_snapshot(str(tmp_path), embeddings, ['a', 'b', 'c'], 'test-model', 'v1', n_lists=10)
+    ids, _ = VectorIndex(str(tmp_path)).search(embeddings, k=1)
+    assert ids[:, 0].tolist() == ['a', 'b', 'c']
+
+
+@pytest.mark.parametrize('item_ids', [[11, 22, 33], ['sku-11', 'sku-22', 'sku-33']])
+def test_lookup_returns_plain_item_ids(tmp_path, item_ids):
+    embeddings = np.eye(3, 8, dtype=np.float32)
+    build_snapshot(str(tmp_path), embeddings, item_ids, 'test-model', 'v1')
+    vectors = {'first': embeddings[0], 'third': embeddings[2]}
+    index = RecommendationIndex(str(tmp_path), lambda model, texts: [vectors[text] for text in texts])
+
+    result = index.lookup(['third', 'first'])
+    assert result == [item_ids[2], item_ids[0]]
+    assert all(type(item_id) is type(item_ids[0]) for item_id in result)
+
+
+def test_lookup_returns_none_below_min_score_or_on_embedding_failure(tmp_path):
+    embeddings = np.eye(2, 4, dtype=np.float32)
+    build_snapshot(str(tmp_path), embeddings, [1, 2], 'test-model', 'v1')
+    vectors = {'close': [1, 0.2, 0, 0], 'unrelated': [0, 0, 1, 0]}
+    index = RecommendationIndex(str(tmp_path), lambda model, texts: [vectors[text] for text in texts], min_score=0.5)
+    assert index.lookup(['close', 'unrelated']) == [1, None]
+
+    def failing_embed(model, texts):
+        raise ConnectionError("embedding service down")
+
+    index.embed = failing_embed
+    assert index.lookup(['close', 'unrelated']) == [None, None]
+
+
+def test_reloads_when_manifest_points_to_a_new_directory(tmp_path):
+    embeddings = np.eye(2, 4, dtype=np.float32)
+    build_snapshot(str(tmp_path), embeddings, [1, 2], 'test-model', 'v1')
+    index = RecommendationIndex(str(tmp_path), lambda model, texts: [embeddings[0]] * len(texts), reload_interval=0)
+    assert index.lookup(['query']) == [1]
+    first_directory = index.index.manifest['directory']
+
+    build_snapshot(str(tmp_path), embeddings, [3, 4], 'test-model', 'v2')
+    # The new snapshot is loaded in the background; the lookup that noticed it is answered from either one
+    assert index.lookup(['query']) in ([1], [3])
+    with index.lock:
+        pass
+    assert index.lookup(['query']) == [3]
+    assert index.index.manifest['directory'] != first_directory
+    assert index.index.version == 'v2'
+    assert os.path.isdir(tmp_path / read_manifest(str(tmp_path))['directory'])
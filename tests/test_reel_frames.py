@@ -0,0 +1,37 @@
+import os
+import time
+
+import pytest
+
+import reel_frames
+
+
+@pytest.fixture(autouse=True)
+def isolated_pool(tmp_path, monkeypatch):
+    monkeypatch.setattr(reel_frames, 'REEL_LOCK_DIR', str(tmp_path))
+    monkeypatch.setattr(reel_frames, 'REEL_MAX_HOST_DECODES', 1)
+    yield
+    if reel_frames.reel_pool is not None:
+        reel_frames.reset_reel_pool(reel_frames.reel_pool, terminate=True)
+
+
+def test_stuck_decode_is_killed_and_releases_its_slot():
+    pool = reel_frames.get_reel_pool()
+    with pytest.raises(reel_frames.ReelTimeoutError):
+        reel_frames.run_in_reel_pool(time.sleep, 30, timeout=1)
+    assert reel_frames.reel_pool is None
+    for process in list((pool._processes or {}).values()):
+        process.join(timeout=5)
+        assert not process.is_alive()
+
+    # The single host slot is free again and a fresh pool serves the next reel
+    with reel_frames.host_decode_slot(timeout=0):
+        pass
+    assert reel_frames.run_in_reel_pool(os.getpid, timeout=30) != os.getpid()
+
+
+def test_busy_when_no_slot_frees_up():
+    with reel_frames.host_decode_slot():
+        with pytest.raises(reel_frames.ReelBusyError):
+            with reel_frames.host_decode_slot(timeout=0.2):
+                pass